@@ -2,88 +2,265 @@
 
 import argparse
 import datetime
+import hashlib
+import io
+import json
 import logging
 import os
 import pathlib
-import queue
-import re
-import threading
+import selectors
+import socket
+import tarfile
 import time
 
+import orjson
 import paramiko
+import requests.adapters
 import scaleway.apis
+import slumber.serialize
 import tenacity
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
 
 
 logger = logging.getLogger(__name__)
 
+LOOKUP_CACHE_TTL = 7 * 24 * 60 * 60
+
+# paramiko's default 2 MiB window stalls verbose nix output on window updates
+SSH_WINDOW_SIZE = 8 * 1024 * 1024
+SSH_MAX_PACKET_SIZE = 512 * 1024
+
+
+def get_lookup_cache_path():
+    # Path.home() raises RuntimeError when there is no usable home directory
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "nixos-scaleway" / "lookup.json"
+
+
+def read_lookup_cache(key):
+    # anything unreadable or malformed is just a cache miss
+    try:
+        entry = json.loads(get_lookup_cache_path().read_text())[key]
+        # a timestamp in the future (clock skew) must not pin the entry
+        if not 0 <= time.time() - entry["timestamp"] <= LOOKUP_CACHE_TTL:
+            return None
+        value = entry["value"]
+    except (OSError, RuntimeError, ValueError, KeyError, TypeError):
+        return None
+    if not isinstance(value, dict) or not {"organization_id", "image_id"} <= set(value):
+        return None
+    return value
+
+
+def write_lookup_cache(key, value):
+    # the cache is only an optimisation, so failing to write it isn't fatal
+    try:
+        path = get_lookup_cache_path()
+        try:
+            cache = json.loads(path.read_text())
+        except (OSError, ValueError):
+            cache = {}
+        if not isinstance(cache, dict):
+            cache = {}
+        cache[key] = {"timestamp": time.time(), "value": value}
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(cache))
+    except (OSError, RuntimeError) as error:
+        logger.warning("Could not write lookup cache: %s", error)
+
 
 def get_minimal_ubuntu(all_images, region, instance_type):
-    # find likely "base Ubuntu" images
-    images = [
-        image
-        for image in all_images
-        if "ubuntu" in image["name"].lower() and "distribution" in image["categories"]
-    ]
-    # newly created entries first, to find the latest "major release"
-    images.sort(key=lambda image: image["creation_date"], reverse=True)
-    # get "public" version for each image
-    public_versions = [
-        version
-        for image in images
-        for version in image["versions"]
-        if version["id"] == image["current_public_version"]
-    ]
-    # find disk images compatible with selected instance type and region
-    compatible_local_images = [
-        image
-        for version in public_versions
-        for image in version["local_images"]
-        if all(
+    # HACK: backcompat region format (e.g. par1 from fr-par-1)
+    legacy_zone = "".join(region.split("-")[-2:])
+    # find likely "base Ubuntu" images, newly created entries first, to find
+    # the latest "major release"
+    images = sorted(
+        (
+            image
+            for image in all_images
+            if "ubuntu" in image["name"].lower()
+            and "distribution" in image["categories"]
+        ),
+        key=lambda image: image["creation_date"],
+        reverse=True,
+    )
+    for image in images:
+        # get "public" version of the image
+        public_version = next(
             (
-                (instance_type in image["compatible_commercial_types"]),
-                # HACK: backcompat region format (e.g. par1 from fr-par-1)
-                (image["zone"] in [region, "".join(region.split("-")[-2:])]),
-            )
+                version
+                for version in image["versions"]
+                if version["id"] == image["current_public_version"]
+            ),
+            None,
         )
-    ]
-    if compatible_local_images:
-        return compatible_local_images[0]["id"]
+        if public_version is None:
+            continue
+        # find disk image compatible with selected instance type and region
+        compatible_by_zone = {}
+        for local_image in public_version["local_images"]:
+            if instance_type in local_image["compatible_commercial_types"]:
+                compatible_by_zone.setdefault(local_image["zone"], local_image["id"])
+        for zone in (region, legacy_zone):
+            if zone in compatible_by_zone:
+                return compatible_by_zone[zone]
     raise Exception("Image not found")
 
 
-@tenacity.retry(stop=tenacity.stop_after_attempt(30))
+class ConditionalGetAdapter(requests.adapters.HTTPAdapter):
+    # remembers each URL's ETag so repeated GETs of an unchanged resource
+    # come back as a bodyless 304 (which slumber returns as None)
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.etags = {}
+
+    def send(self, request, **kwargs):
+        if request.method == "GET" and request.url in self.etags:
+            request.headers["If-None-Match"] = self.etags[request.url]
+        response = super().send(request, **kwargs)
+        if request.method == "GET" and "ETag" in response.headers:
+            self.etags[request.url] = response.headers["ETag"]
+        return response
+
+
+class OrjsonSerializer(slumber.serialize.JsonSerializer):
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+def share_session(api):
+    # scaleway.apis creates a new requests.Session (and so a new TLS
+    # connection) for every query(); reuse one pooled session instead
+    session = api.make_requests_session()
+    session.mount(
+        "https://",
+        ConditionalGetAdapter(
+            pool_connections=4,
+            pool_maxsize=16,
+            # the SDK already retries 502/503/504 itself, so only add 429
+            max_retries=requests.adapters.Retry(
+                total=5,
+                backoff_factor=0.5,
+                status_forcelist=[429],
+                raise_on_status=False,
+            ),
+        ),
+    )
+    api.make_requests_session = lambda: session
+
+
+def poll_until(fetch, predicate, initial=1.0, factor=2.0, cap=15.0, timeout=3600):
+    delay = initial
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        response = fetch()
+        if response is not None and predicate(response):
+            return response
+        time.sleep(delay)
+        delay = min(delay * factor, cap)
+    raise Exception("Timed out while polling")
+
+
+def wait_for_state(resource, kind, state):
+    # the returned object is the freshest copy, so callers reuse it rather
+    # than fetching again
+    response = poll_until(
+        resource.get, lambda response: response[kind]["state"] == state
+    )
+    return response[kind]
+
+
+@tenacity.retry(
+    stop=tenacity.stop_after_delay(300),
+    wait=tenacity.wait_fixed(1),
+    retry=tenacity.retry_if_exception_type(OSError),
+)
+def wait_for_port(ip_address, port):
+    # a bare TCP connect is much cheaper than a full SSH handshake attempt
+    socket.create_connection((ip_address, port), timeout=2).close()
+
+
+@tenacity.retry(
+    stop=tenacity.stop_after_delay(180),
+    wait=tenacity.wait_exponential(multiplier=0.5, max=10)
+    + tenacity.wait_random(0, 0.5),
+    # EOFError: sshd dropping the connection mid-handshake, e.g. while
+    # cloud-init regenerates host keys and restarts it
+    retry=tenacity.retry_if_exception_type((OSError, EOFError, paramiko.SSHException)),
+)
 def ssh_connect(ip_address, private_key):
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy)
     client.connect(hostname=ip_address, username="root", pkey=private_key, timeout=5)
+    client.get_transport().set_keepalive(30)
     return client
 
 
-def read_lines(streams):
-    q = queue.Queue()
-
-    def read_stream(stream):
-        for line in stream:
-            q.put(line)
+def exec_command(client, command):
+    channel = client.get_transport().open_session(
+        window_size=SSH_WINDOW_SIZE, max_packet_size=SSH_MAX_PACKET_SIZE
+    )
+    channel.exec_command(command)
+    return channel
 
-    threads = [
-        threading.Thread(target=read_stream, args=(stream,), daemon=True)
-        for stream in streams
-    ]
-    for thread in threads:
-        thread.start()
 
-    while True:
-        try:
-            yield q.get(timeout=0.01)
-        except queue.Empty:
-            if not any(thread.is_alive() for thread in threads):
+def generate_private_key():
+    key_data = ed25519.Ed25519PrivateKey.generate().private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.OpenSSH,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    return paramiko.Ed25519Key.from_private_key(io.StringIO(key_data.decode()))
+
+
+def upload_files(client, entries, destination):
+    # one tar stream instead of an open/write/close round trip per file
+    # root's tar would otherwise keep the local uid/gid on extraction
+    channel = exec_command(client, f"tar --no-same-owner -xf - -C {destination}")
+    with channel.makefile("wb") as stdin:
+        with tarfile.open(fileobj=stdin, mode="w|") as archive:
+            for entry in entries:
+                archive.add(entry.path, arcname=entry.name)
+    channel.shutdown_write()
+    with channel.makefile_stderr("rb") as stderr:
+        errors = stderr.read().decode(errors="replace").strip()
+    if channel.recv_exit_status() != 0:
+        raise Exception(f"Failed to copy bootstrap files: {errors}")
+
+
+def read_lines(channel, chunk_size=65536):
+    streams = (
+        (channel.recv_ready, channel.recv),
+        (channel.recv_stderr_ready, channel.recv_stderr),
+    )
+    buffers = [b"", b""]
+    with selectors.DefaultSelector() as selector:
+        # paramiko signals the channel's fileno while either stream has data
+        # buffered, and permanently once EOF arrives; the loop below exits as
+        # soon as the streams are drained after EOF, so it never spins on it
+        selector.register(channel, selectors.EVENT_READ)
+        while True:
+            selector.select()
+            for index, (ready, recv) in enumerate(streams):
+                if ready():
+                    data = buffers[index] + recv(chunk_size)
+                    *lines, buffers[index] = data.split(b"\n")
+                    yield from (line.decode(errors="replace") for line in lines)
+            # exit-status can arrive before the output has been drained, so
+            # only stop once EOF (or close) is seen and both streams are empty
+            if (
+                (channel.eof_received or channel.closed)
+                and not channel.recv_ready()
+                and not channel.recv_stderr_ready()
+            ):
                 break
+    # flush any trailing output that wasn't newline-terminated
+    yield from (buffer.decode(errors="replace") for buffer in buffers if buffer)
 
 
 def flatten_whitespace(lines):
-    yield from filter(None, (re.sub("\s+", " ", l).strip() for l in lines))
+    yield from filter(None, (" ".join(l.split()) for l in lines))
 
 
 def get_args(argv=None):
@@ -100,6 +277,7 @@ def get_args(argv=None):
     parser.add_argument("--region", default="fr-par-1")
     parser.add_argument("--instance-type", default="DEV1-M")
     parser.add_argument("--bootstrap-disk-size", default=20)
+    parser.add_argument("--no-lookup-cache", action="store_true")
     return parser.parse_args(argv)
 
 
@@ -116,146 +294,123 @@ def main(argv=None):
     compute = scaleway.apis.ComputeAPI(
         auth_token=args.secret_key, base_url="https://api.scaleway.com/"
     )
-
-    organization_id = account.query().organizations.get()["organizations"][0]["id"]
+    for api in (account, marketplace, compute):
+        share_session(api)
+    serializer = slumber.serialize.Serializer(
+        default="json", serializers=[OrjsonSerializer()]
+    )
+    zone = compute.query(serializer=serializer).instance.v1.zones(args.region)
+
+    # organization and image IDs almost never change, so skip looking them
+    # up on every run; the key is scoped to the account without storing it
+    lookup_key = "/".join(
+        (
+            hashlib.sha256(args.secret_key.encode()).hexdigest()[:16],
+            args.region,
+            args.instance_type,
+        )
+    )
+    lookup = None if args.no_lookup_cache else read_lookup_cache(lookup_key)
+    if lookup is None:
+        organizations = account.query(serializer=serializer).organizations.get()[
+            "organizations"
+        ]
+        images = marketplace.query(serializer=serializer).images.get()["images"]
+        lookup = {
+            "organization_id": organizations[0]["id"],
+            "image_id": get_minimal_ubuntu(images, args.region, args.instance_type),
+        }
+        write_lookup_cache(lookup_key, lookup)
+
+    organization_id = lookup["organization_id"]
     logger.info("Using organization ID %s", organization_id)
 
-    image_id = get_minimal_ubuntu(
-        marketplace.query().images.get()["images"], args.region, args.instance_type
-    )
+    image_id = lookup["image_id"]
     logger.info("Using bootstrap (Ubuntu) image ID %s", image_id)
 
-    private_key = paramiko.ECDSAKey.generate(bits=256)
-    server = (
-        compute.query()
-        .instance.v1.zones(args.region)
-        .servers.post(
-            {
-                "organization": organization_id,
-                "name": "nixos-image-builder",
-                "image": image_id,
-                "commercial_type": args.instance_type,
-                "volumes": {
-                    "0": {"size": 1_000_000_000 * args.bootstrap_disk_size},
-                    "1": {
-                        "name": "nixos-volume",
-                        "organization": organization_id,
-                        "volume_type": "l_ssd",
-                        "size": 20_000_000_000,
-                    },
+    private_key = generate_private_key()
+    public_key = private_key.get_base64()
+    server = zone.servers.post(
+        {
+            "organization": organization_id,
+            "name": "nixos-image-builder",
+            "image": image_id,
+            "commercial_type": args.instance_type,
+            "volumes": {
+                "0": {"size": 1_000_000_000 * args.bootstrap_disk_size},
+                "1": {
+                    "name": "nixos-volume",
+                    "organization": organization_id,
+                    "volume_type": "l_ssd",
+                    "size": 20_000_000_000,
                 },
-                "boot_type": "local",
-                "tags": [
-                    "AUTHORIZED_KEY="
-                    + private_key.get_name()
-                    + "_"
-                    + private_key.get_base64()
-                ],
-            }
-        )["server"]
-    )
+            },
+            "boot_type": "local",
+            "tags": [f"AUTHORIZED_KEY={private_key.get_name()}_{public_key}"],
+        }
+    )["server"]
+    server_api = zone.servers(server["id"])
     logger.info("Provisioned instance %s", server["id"])
 
     logger.info("Starting instance, this may take a bit...")
-    response = (
-        compute.query()
-        .instance.v1.zones(args.region)
-        .servers(server["id"])
-        .action.post({"action": "poweron"})
-    )
+    server_api.action.post({"action": "poweron"})
 
-    while True:
-        server = (
-            compute.query()
-            .instance.v1.zones(args.region)
-            .servers(server["id"])
-            .get()["server"]
-        )
-        if server["state"] == "running":
-            break
-        time.sleep(1)
+    server = wait_for_state(server_api, "server", "running")
+    ip_address = server["public_ip"]["address"]
     logger.info("Instance running")
 
-    logger.info("Attempting to SSH to root@%s", server["public_ip"]["address"])
-    client = ssh_connect(server["public_ip"]["address"], private_key)
+    logger.info("Waiting for SSH port on %s", ip_address)
+    wait_for_port(ip_address, 22)
+
+    logger.info("Attempting to SSH to root@%s", ip_address)
+    client = ssh_connect(ip_address, private_key)
 
     logger.info("Copying bootstrap files")
-    sftp = client.open_sftp()
     bootstrap_file_path = pathlib.Path(__file__).parent / "bootstrap"
-    for bootstrap_file in bootstrap_file_path.glob("*"):
-        filename = bootstrap_file.relative_to(bootstrap_file_path)
-        source = str(bootstrap_file.resolve())
-        destination = str(pathlib.PurePosixPath("/tmp") / filename)
-        sftp.put(source, destination)
+    with os.scandir(bootstrap_file_path) as entries:
+        bootstrap_files = [entry for entry in entries if entry.is_file()]
+    upload_files(client, bootstrap_files, "/tmp")
 
     logger.info("Executing NixOS bootstrap")
-    _, stdout, stderr = client.exec_command("bash /tmp/nix-bootstrap.sh")
-    for line in flatten_whitespace(read_lines((stdout, stderr))):
+    channel = exec_command(client, "bash /tmp/nix-bootstrap.sh")
+    for line in flatten_whitespace(read_lines(channel)):
         logger.info(line)
-    status = stdout.channel.recv_exit_status()
+    status = channel.recv_exit_status()
     logger.info("Bootstrap exited with status %d", status)
 
     if status not in (-1, 0):
         raise Exception("Failed to bootstrap")
 
     logger.info("Waiting for instance to stop...")
-    while True:
-        server = (
-            compute.query()
-            .instance.v1.zones(args.region)
-            .servers(server["id"])
-            .get()["server"]
-        )
-        if server["state"] == "stopped in place":
-            break
-        time.sleep(1)
+    server = wait_for_state(server_api, "server", "stopped in place")
 
     image_name = (
         "nixos-" + datetime.datetime.utcnow().replace(microsecond=0).isoformat()
     )
-    snapshot = (
-        compute.query()
-        .instance.v1.zones(args.region)
-        .snapshots.post(
-            {
-                "volume_id": server["volumes"]["1"]["id"],
-                "organization": organization_id,
-                "name": image_name,
-            }
-        )["snapshot"]
-    )
+    snapshot = zone.snapshots.post(
+        {
+            "volume_id": server["volumes"]["1"]["id"],
+            "organization": organization_id,
+            "name": image_name,
+        }
+    )["snapshot"]
     logger.info("Created snapshot ID %s", snapshot["id"])
 
     logger.info("Waiting for snapshot to become available")
-    while True:
-        snapshot = (
-            compute.query()
-            .instance.v1.zones(args.region)
-            .snapshots(snapshot["id"])
-            .get()["snapshot"]
-        )
-        if snapshot["state"] == "available":
-            break
-        time.sleep(1)
-
-    image = (
-        compute.query()
-        .instance.v1.zones(args.region)
-        .images.post(
-            {
-                "name": image_name,
-                "root_volume": snapshot["id"],
-                "arch": server["arch"],
-                "organization": organization_id,
-            }
-        )["image"]
-    )
+    snapshot = wait_for_state(zone.snapshots(snapshot["id"]), "snapshot", "available")
+
+    image = zone.images.post(
+        {
+            "name": image_name,
+            "root_volume": snapshot["id"],
+            "arch": server["arch"],
+            "organization": organization_id,
+        }
+    )["image"]
     logger.info("Created NixOS image ID %s", image["id"])
 
     logger.info("Deleting server ID %s", server["id"])
-    compute.query().instance.v1.zones(args.region).servers(server["id"]).action.post(
-        {"action": "terminate"}
-    )
+    server_api.action.post({"action": "terminate"})
 
     logger.info("Done")
 